@@ -1,25 +1,74 @@
-import json
 import logging
 import re
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from queue import Queue
+from threading import Thread
+from typing import List, Dict, Tuple
 
+import orjson
 import requests
 from django.http import HttpResponseServerError
 from medcat.cdb import CDB
+from requests.adapters import HTTPAdapter
 from rest_framework.response import Response
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
 
 from api.models import ConceptDB
 from core.settings import SOLR_HOST, SOLR_PORT
 
 SOLR_INDEX_SCHEMA = {}
 
+# number of concepts per payload handed to the upload thread during a full CDB import, i.e. the granularity
+# of build / upload pipelining. Request bodies are bounded separately by SOLR_MAX_UPDATE_BYTES.
+IMPORT_BATCH_SIZE = 20000
+
+# seconds to wait on solr for a single update request
+SOLR_UPDATE_TIMEOUT = 60
+
+# update request bodies are split to stay below solr / jetty's default 2MB request size limit
+SOLR_MAX_UPDATE_BYTES = 1536 * 1024
+
+# bracketed qualifiers, e.g. '(disorder)', stripped from concept names before indexing
+_PAREN_STRIP_RE = re.compile(r'\([\w+\s]+\)')
+
+# lucene query syntax characters / operators, escaped in user supplied search terms
+_LUCENE_SPECIAL_RE = re.compile(r'([+\-!(){}\[\]^"~*?:\\/]|&&|\|\|)')
+
+# select params for concept searches, only returning the fields used by _process_result_repsonse
+_SEARCH_PARAMS = {'q.op': 'OR', 'rows': 15, 'fl': 'cui,pretty_name,type_ids,synonyms'}
+
+
+class _SolrRetry(Retry):
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        # a timed out update is most likely still being processed by solr, resending it only adds load
+        if method == 'POST' and isinstance(error, ReadTimeoutError):
+            raise error
+        return super().increment(method=method, url=url, response=response, error=error, _pool=_pool,
+                                 _stacktrace=_stacktrace)
+
+
+# shared session so calls to solr reuse pooled keep-alive connections, retrying transient
+# connection resets and gateway / unavailable errors. Exhausted status retries return the last
+# response rather than raising, so callers still report the solr error.
+_SOLR_SESSION = requests.Session()
+_SOLR_SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                                           max_retries=_SolrRetry(total=3, backoff_factor=0.2,
+                                                                  status_forcelist=[502, 503, 504],
+                                                                  allowed_methods={'GET', 'POST'},
+                                                                  raise_on_status=False)))
+
+# bounded pool shared by all requests for concurrent solr fan-out, rather than spawning threads per request
+_SOLR_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='solr')
+
 logger = logging.getLogger(__name__)
 
 
 def _cache_solr_collection_schema_types(collection):
     url = f'http://{SOLR_HOST}:{SOLR_PORT}/solr/{collection}/schema'
     logger.info(f'Retrieving solr schema: {url}')
-    resp = json.loads(requests.get(url).text)
+    resp = orjson.loads(_SOLR_SESSION.get(url).content)
     cui_type = [n for n in resp['schema']['fields'] if n['name'] == 'cui'][0]['type']
     # just store cui type for the time being
     SOLR_INDEX_SCHEMA[collection] = {'cui': cui_type}
@@ -27,12 +76,12 @@ def _cache_solr_collection_schema_types(collection):
 
 def collections_available(cdbs: List[int]):
     url = f'http://{SOLR_HOST}:{SOLR_PORT}/solr/admin/collections?action=LIST'
-    resp = requests.get(url)
-    if resp.status_code == 200:
-        collections = json.loads(resp.text)['collections']
-        # cache schema field types
-        for col in collections:
-            _cache_solr_collection_schema_types(col)
+    resp = _SOLR_SESSION.get(url)
+    if resp.ok:
+        collections = orjson.loads(resp.content)['collections']
+        # (re)cache schema field types, fetched concurrently as each collection is independent. Always refreshed
+        # here as collections are recreated by concept imports in the background task process.
+        list(_SOLR_EXECUTOR.map(_cache_solr_collection_schema_types, collections))
         current_collections_cdb_ids = [c.split('_id_')[-1] for c in collections]
         if len(cdbs):
             return Response({'results': {cdb_id: cdb_id in current_collections_cdb_ids for cdb_id in cdbs}})
@@ -45,19 +94,35 @@ def collections_available(cdbs: List[int]):
 
 def _process_result_repsonse(resp: Dict):
     uniq_results_map = {}
-    docs = [d for d in resp['response']['docs']]
-    for d in docs:
-        if d['cui'][0] not in uniq_results_map:
-            parsed_doc = {
-                'cui': str(d['cui'][0]),
-                'pretty_name': d['pretty_name'][0],
-                'type_ids': d.get('type_ids', []),
-                'synonyms': d['synonyms']
-            }
-            uniq_results_map[d['cui'][0]] = parsed_doc
+    for d in resp['response']['docs']:
+        cui = d['cui'][0]
+        if cui in uniq_results_map:
+            continue
+        uniq_results_map[cui] = {
+            'cui': str(cui),
+            'pretty_name': d['pretty_name'][0],
+            'type_ids': d.get('type_ids', []),
+            'synonyms': d['synonyms']
+        }
     return uniq_results_map
 
 
+def _escape_solr_query(token: str):
+    return _LUCENE_SPECIAL_RE.sub(r'\\\1', token)
+
+
+def _query_collection(collection_name: str, query_str: str, query: List[str]):
+    solr_url = f'http://{SOLR_HOST}:{SOLR_PORT}/solr/{collection_name}/select'
+    logger.info(f'Searching solr collection {collection_name} with query: {query_str}')
+    resp = orjson.loads(_SOLR_SESSION.get(solr_url, params={**_SEARCH_PARAMS, 'q': query_str}).content)
+    if 'error' not in resp and len(resp['response']['docs']) == 0:
+        # try with wildcards at the end of the entire query, rather than each token
+        fallback_query = f'name:{" ".join(query)}* synonyms:{" ".join(query)}*'
+        logger.info(f'Searching solr collection {collection_name} with fall back query: {fallback_query}')
+        resp = orjson.loads(_SOLR_SESSION.get(solr_url, params={**_SEARCH_PARAMS, 'q': fallback_query}).content)
+    return resp
+
+
 def search_collection(cdbs: List[int], raw_query: str):
     query = raw_query.strip().replace(r'\s+', r'\s').split(' ')
     if len(query) == 1 and query[0] == '':
@@ -65,37 +130,38 @@ def search_collection(cdbs: List[int], raw_query: str):
     res = []
     if len(cdbs) > 0:
         uniq_results_map = {}
+        try:
+            # a numeric cui query is the same for every collection
+            numeric_query_str = f'cui:{int(query[0])}'
+        except ValueError:
+            numeric_query_str = None
+        # user input is escaped so that lucene syntax characters are searched for literally
+        escaped_query = [_escape_solr_query(q) for q in query]
+        collection_queries = []
+        cdb_models = ConceptDB.objects.in_bulk([int(cdb) for cdb in cdbs])
         for cdb in cdbs:
-            cdb_model = ConceptDB.objects.get(id=cdb)
+            cdb_model = cdb_models[int(cdb)]
             collection_name = f'{cdb_model.name}_id_{cdb_model.id}'
-            if collection_name not in SOLR_INDEX_SCHEMA:
-                _cache_solr_collection_schema_types(collection_name)
-            try:
-                query_num = int(query[0])
-                query_str = f'cui:{query_num}'
-            except ValueError:
+            if numeric_query_str is not None:
+                query_str = numeric_query_str
+            else:
                 # cannot be a cui if multi-word, OR single word, not a numeric cui
-                query_str = f'name:"{" ".join(query)}"^2 synonyms:"{" ".join(query)}"'
+                if collection_name not in SOLR_INDEX_SCHEMA:
+                    _cache_solr_collection_schema_types(collection_name)
+                query_str = f'name:"{" ".join(escaped_query)}"^2 synonyms:"{" ".join(escaped_query)}"'
                 if len(query) == 1 and SOLR_INDEX_SCHEMA[collection_name]['cui'] != 'plongs':
                     # single word, alphanumeric cui type.
-                    query_str = f'cui:{query[0]} ' + query_str
+                    query_str = f'cui:{escaped_query[0]} ' + query_str
+            collection_queries.append((collection_name, query_str))
 
-            solr_url = f'http://{SOLR_HOST}:{SOLR_PORT}/solr/{collection_name}/select?q.op=OR&q={query_str}&rows=15'
-            logger.info(f'Searching solr collection: {solr_url}')
-            resp = json.loads(requests.get(solr_url).text)
+        # each collection search is independent, so issue them concurrently
+        resps = list(_SOLR_EXECUTOR.map(lambda cq: _query_collection(*cq, escaped_query), collection_queries))
 
+        for (collection_name, _), resp in zip(collection_queries, resps):
             if 'error' in resp:
                 return HttpResponseServerError(f'Concept Search Index {collection_name} not available, '
                                                f'import concept DB first before trying to search it.')
-            elif len(resp['response']['docs']) == 0:
-                # try with wildcards at the end of the entire query, rather than each token
-                fallback_query = f'name:{" ".join(query)}* synonyms:{" ".join(query)}*'
-                solr_url = f'http://{SOLR_HOST}:{SOLR_PORT}/solr/{collection_name}/select?q.op=OR&q={fallback_query}&rows=15'
-                logger.info(f'Searching solr collection with fall back query at url: {solr_url}')
-                resp = json.loads(requests.get(solr_url).text)
-                uniq_results_map.update(_process_result_repsonse(resp))
-            else:
-                uniq_results_map.update(_process_result_repsonse(resp))
+            uniq_results_map.update(_process_result_repsonse(resp))
 
         res = sorted(uniq_results_map.values(), key=lambda r: len(r['pretty_name']))
     return Response({'results': res})
@@ -107,51 +173,66 @@ def import_all_concepts(cdb: CDB, cdb_model: ConceptDB):
 
     # check if solr collections already exists.
     url = f'{base_url}/admin/collections?action=LIST'
-    resp = requests.get(url)
-    if resp.status_code != 200:
+    resp = _SOLR_SESSION.get(url)
+    if not resp.ok:
         logger.error("Error connecting to Solr to retrieve current collection list")
         raise Exception("Error connecting to Solr to retrieve current collection list")
 
-    collections = json.loads(resp.text)['collections']
+    collections = orjson.loads(resp.content)['collections']
     if collection_name in collections:
         # delete collection
         url = f'{base_url}/admin/collections?action=DELETE&name={collection_name}'
-        requests.get(url)
+        _SOLR_SESSION.get(url)
 
     # create solr collections.
     url = f'{base_url}/admin/collections?action=CREATE&name={collection_name}&numShards=1'
-    resp = requests.get(url)
-    if resp.status_code != 200:
+    resp = _SOLR_SESSION.get(url)
+    if not resp.ok:
         _solr_error_response(resp, 'Failure creating collection')
 
-    cui2name_iter = iter(cdb.cui2names.items())
-
-    payload = []
+    update_url = f'{base_url}/{collection_name}/update'
+    # build the next payload while the previous one is being uploaded by a background thread
+    upload_queue = Queue(maxsize=2)
+    upload_errors = []
+    uploader = Thread(target=_upload_worker, args=(upload_queue, update_url, collection_name, upload_errors),
+                      daemon=True)
+    uploader.start()
+    cui_iter = iter(cdb.cui2names)
+    # resolved once, rather than per concept
+    cui2original_names = cdb.addl_info.get('cui2original_names', {})
+    cui2description = cdb.addl_info.get('cui2description', {})
     try:
-        while True:
-            for i in range(5000):
-                cui, name = next(cui2name_iter)
-                concept_dct = _concept_dct(cui, cdb)
-                payload.append(concept_dct)
-            _upload_payload(f'{base_url}/{collection_name}/update', payload, collection_name)
-            payload = []
-    except StopIteration:
-        # upload last update
-        _upload_payload(f'{base_url}/{collection_name}/update', payload, collection_name, commit=True)
+        while not upload_errors:
+            batch_cuis = list(islice(cui_iter, IMPORT_BATCH_SIZE))
+            if not batch_cuis:
+                break
+            upload_queue.put([_concept_dct(cui, cdb, cui2original_names, cui2description) for cui in batch_cuis])
+    finally:
+        upload_queue.put(None)
+        uploader.join()
+    if upload_errors:
+        raise upload_errors[0]
+
+    # commit once all batches are uploaded, merging segments as the collection is now read-mostly
+    # no timeout here, optimizing a large collection can take minutes
+    resp = _SOLR_SESSION.get(update_url, params={'commit': 'true', 'optimize': 'true'})
+    if not resp.ok:
+        _solr_error_response(resp, f'error committing {collection_name}')
 
     # get final collection size
     logger.info(f'Successfully uploaded {cdb_model.name} cuis / names to solr collection {collection_name}')
 
-    resp = requests.get(f'{base_url}/{collection_name}/select?q=*:*&rows=0')
-    logger.info(f'{json.loads(resp.text)["response"]["numFound"]} Concepts now searchable')
+    resp = _SOLR_SESSION.get(f'{base_url}/{collection_name}/select?q=*:*&rows=0')
+    logger.info(f'{orjson.loads(resp.content)["response"]["numFound"]} Concepts now searchable')
 
 
 def drop_collection(cdb_model: ConceptDB):
     collection_name = f'{cdb_model.name}_id_{cdb_model.id}'
     base_url = f'http://{SOLR_HOST}:{SOLR_PORT}/solr'
     url = f'{base_url}/admin/collections?action=DELETE&name={collection_name}'
-    resp = requests.get(url)
-    if resp.status_code == 200:
+    resp = _SOLR_SESSION.get(url)
+    SOLR_INDEX_SCHEMA.pop(collection_name, None)
+    if resp.ok:
         logger.info(f'Successfullly dropped concept collection:{collection_name}')
     else:
         logger.warning(f'Error dropping concept collection {collection_name}, error: {resp.text}')
@@ -168,40 +249,82 @@ def ensure_concept_searchable(cui, cdb: CDB, cdb_model: ConceptDB):
     collection = f'{cdb_model.name}_id_{cdb_model.id}'
     base_url = f'http://{SOLR_HOST}:{SOLR_PORT}/solr'
     url = f'{base_url}/admin/collections?action=LIST'
-    resp = requests.get(url)
-    if resp.status_code == 200:
-        collections = json.loads(resp.text)['collections']
-        data = [_concept_dct(cui, cdb)]
+    resp = _SOLR_SESSION.get(url)
+    if resp.ok:
+        collections = orjson.loads(resp.content)['collections']
+        data = [_concept_dct(cui, cdb, cdb.addl_info.get('cui2original_names', {}),
+                             cdb.addl_info.get('cui2description', {}))]
         if collection in collections:
             _upload_payload(f'{base_url}/{collection}/update', data, collection, commit=True)
 
 
+def _upload_worker(upload_queue: Queue, update_url: str, collection: str, errors: List[Exception]):
+    # uploads payloads until the None sentinel, recording the first failure for the producer to raise
+    while True:
+        payload = upload_queue.get()
+        if payload is None:
+            return
+        if errors:
+            continue
+        try:
+            _upload_payload(update_url, payload, collection)
+        except Exception as e:
+            errors.append(e)
+
+
 def _upload_payload(update_url, data, collection, commit=False):
-    update_url = f'{update_url}?commit=true' if commit else update_url
-    logger.info(f'Uploading {len(data)} to solr collection {collection}')
-    resp = requests.post(update_url, json=data)
-    if resp.status_code == 200:
-        logger.info(f'Successfully uploaded {len(data)} concepts to solr collection {collection}')
-    elif resp.status_code != 200:
-        _solr_error_response(resp, f'error updating {collection}')
+    bodies = _split_payload(data)
+    for i, (n_docs, body) in enumerate(bodies):
+        logger.info(f'Uploading {n_docs} to solr collection {collection}')
+        # only commit with the final request
+        resp = _SOLR_SESSION.post(update_url, data=body, headers={'Content-Type': 'application/json'},
+                                  params={'commit': 'true'} if commit and i == len(bodies) - 1 else None,
+                                  timeout=SOLR_UPDATE_TIMEOUT)
+        if resp.ok:
+            logger.info(f'Successfully uploaded {n_docs} concepts to solr collection {collection}')
+        else:
+            _solr_error_response(resp, f'error updating {collection}')
 
 
-def _concept_dct(cui: str, cdb: CDB):
-    synonyms = list(cdb.addl_info.get('cui2original_names', {}).get(cui, set()))
+def _split_payload(data) -> List[Tuple[int, bytes]]:
+    """
+    Serialises docs into JSON array request bodies, each kept under SOLR_MAX_UPDATE_BYTES where possible.
+    Args:
+        data: list of solr docs to upload
+    Returns:
+        list of (number of docs, JSON body) pairs
+    """
+    bodies = []
+    docs, size = [], 2
+    for doc in map(orjson.dumps, data):
+        if docs and size + len(doc) + 1 > SOLR_MAX_UPDATE_BYTES:
+            bodies.append((len(docs), b'[' + b','.join(docs) + b']'))
+            docs, size = [], 2
+        docs.append(doc)
+        size += len(doc) + 1
+    bodies.append((len(docs), b'[' + b','.join(docs) + b']'))
+    return bodies
+
+
+def _concept_dct(cui: str, cdb: CDB, cui2original_names: Dict, cui2description: Dict):
+    synonyms = list(cui2original_names.get(cui, set()))
+    pretty_name = cdb.get_name(cui)
     concept_dct = {
+        # keyed on cui so a retried or repeated add overwrites the doc, rather than solr assigning a new random id
+        'id': str(cui),
         'cui': str(cui),
-        'pretty_name': cdb.get_name(cui),
-        'name': re.sub(r'\([\w+\s]+\)', '', cdb.get_name(cui)).strip(),
+        'pretty_name': pretty_name,
+        'name': _PAREN_STRIP_RE.sub('', pretty_name).strip(),
         'type_ids': list(cdb.cui2type_ids[cui]),
-        'desc': cdb.addl_info.get('cui2description', {}).get(cui, ''),
-        'synonyms': synonyms if len(synonyms) > 0 else [cdb.get_name(cui)]
+        'desc': cui2description.get(cui, ''),
+        'synonyms': synonyms if len(synonyms) > 0 else [pretty_name]
     }
     return concept_dct
 
 
 def _solr_error_response(resp, error_msg):
     try:
-        error = json.loads(resp.text)['error']
+        error = orjson.loads(resp.content)['error']
     except Exception as e:
         logger.error(f'{error_msg}: unknown error')
         raise e